@@ -1,8 +1,11 @@
 from qiskit.circuit import QuantumCircuit, QuantumRegister, AncillaRegister,ClassicalRegister
-from qiskit.quantum_info import Statevector, Operator, partial_trace
+from qiskit.quantum_info import Statevector, Operator, partial_trace, StabilizerState
 from qiskit.circuit import Measure
 import itertools
+import functools
+import collections
 from qiskit_aer import AerSimulator
+import qiskit_aer.library
 import matplotlib.pyplot as plt
 from qiskit.primitives import SamplerResult
 from qiskit.providers.basic_provider import BasicProvider
@@ -48,11 +51,37 @@ def LogicalX0_circuit(ToricLattice):
     return LogicalX0Prep
 
 
+@functools.lru_cache(maxsize=None)
+def GroundStateStabilizer(rows, cols, x_0, x_1, num_ancillas=0):
+    # returns the logical state |x_0 x_1>_L (the state prepared by PrepareGroundState followed by LogicalX0_circuit
+    # and LogicalX1_circuit) as a StabilizerState, built directly from its stabilizer group: all star operators,
+    # all plaquette operators and the logical Z operators with signs (-1)^x_0, (-1)^x_1.
+    # num_ancillas further qubits in |0> are appended after the data qubits, so that the state can be loaded with
+    # set_stabilizer, which has to act on the full width of a circuit. cached per lattice size and logical input
+    ToricLattice = Lattice(rows, cols)
+    num_of_qubits = ToricLattice.num_of_qubits + num_ancillas
 
+    def pauli_string(support, pauli):
+        # qiskit orders pauli strings with qubit 0 on the right
+        support = np.concatenate([support, np.zeros(num_ancillas, dtype=np.uint8)])
+        return ''.join(pauli if support[q] else 'I' for q in reversed(range(num_of_qubits)))
 
-def syndrome_measurement(ToricLattice, LatticeCircuit, shape):
+    stabilizers = [pauli_string(S, 'X') for S in ToricLattice.star_check_matrix()]
+    stabilizers += [pauli_string(P, 'Z') for P in ToricLattice.plaquette_check_matrix()]
+    for logical_z, x in zip(ToricLattice.logical_z_supports(), [x_0, x_1]):
+        stabilizers.append(('-' if x == 1 else '') + pauli_string(logical_z, 'Z'))
+    for q in range(ToricLattice.num_of_qubits, num_of_qubits):
+        stabilizers.append(''.join('Z' if i == q else 'I' for i in reversed(range(num_of_qubits))))
+
+    return StabilizerState.from_stabilizer_list(stabilizers, allow_redundant=True)
+
+
+
+
+def syndrome_measurement(ToricLattice, LatticeCircuit, shape, meas=None):
     syndromes = LatticeCircuit.ancillas[:]
-    meas = LatticeCircuit.clbits[:]
+    if meas is None:
+        meas = LatticeCircuit.clbits[:]
     DataQubits = LatticeCircuit.qubits[0: 2*ToricLattice.rows * ToricLattice.cols ]
     k=0 
     for i in range(ToricLattice.rows):
@@ -101,10 +130,105 @@ def ApplyPauliError(quantum_circuit, qubits, p_error):
             quantum_circuit.z(qubit)
         if error_choice == 3:
             quantum_circuit.y(qubit)
-          
-    
-    
-         
+
+
+def sample_pauli_errors(num_qubits, p_error, num_shots, rng=None):
+    # vectorized version of ApplyPauliError: samples the same Pauli channel for num_shots shots at once.
+    # returns two num_shots x num_qubits uint8 arrays (bit flips, phase flips); a Y error sets both.
+    if rng is None:
+        rng = np.random.default_rng()
+    error_choice = rng.choice([0,1,2,3], size=(num_shots, num_qubits), p=[1 - p_error, p_error/3, p_error/3, p_error/3])
+    x_errors = ((error_choice == 1) | (error_choice == 3)).astype(np.uint8)
+    z_errors = ((error_choice == 2) | (error_choice == 3)).astype(np.uint8)
+    return x_errors, z_errors
+
+
+def sample_sparse_pauli_errors(num_qubits, p_error, num_shots, rng=None):
+    # samples the Pauli channel of ApplyPauliError for num_shots shots, but returns every shot sparsely as the list of
+    # (qubit, 'X' / 'Z' / 'Y') that were hit. at low error rates most of these lists are empty or have a single entry
+    if rng is None:
+        rng = np.random.default_rng()
+    if num_shots == 0:
+        return []
+    shots, qubits = np.nonzero(rng.random((num_shots, num_qubits)) < p_error)
+    paulis = np.array(['X', 'Z', 'Y'])[rng.integers(0, 3, len(qubits))]
+    boundaries = np.searchsorted(shots, np.arange(1, num_shots))
+    return [list(zip(q.tolist(), pauli.tolist())) for q, pauli in zip(np.split(qubits, boundaries), np.split(paulis, boundaries))]
+
+
+@functools.lru_cache(maxsize=None)
+def correction_path_table(rows, cols, shape):
+    # returns a (rows*cols) x (rows*cols) x ceil(2*rows*cols / 8) table, entry [a, b] is the bit-packed flat mask of the
+    # qubits along star_path (or plaquette_path) from stars_lin[a] to stars_lin[b] (or plaquettes_lin).
+    # the paths are computed once per lattice size (by the path_table kernel); applying a correction is then an XOR
+    # of table entries
+    table = path_table(rows, cols, shape).reshape(rows*cols, rows*cols, 2*rows*cols)
+    table = np.packbits(table, axis=2)
+    table.setflags(write=False)
+    return table
+
+
+def matching_pairs(ToricLattice, positions, shape):
+    # minimum weight perfect matching of the marked stars (or plaquettes) at positions, exactly as in KitaevToricModel.
+    # returns the matched pairs as a list of (stars_lin index, stars_lin index) tuples
+    if len(positions) == 0:
+        return []
+    if shape == 'star':
+        graph = ToricLattice.marked_stars_graph(positions)
+    if shape == 'plaquette':
+        graph = ToricLattice.marked_plaquettes_graph(positions)
+    return list(nx.min_weight_matching(graph, weight='weight'))
+
+
+def sector_matching_pairs(rows, cols, syndromes, shape, first_shot=0):
+    # matches every shot of a batch of syndromes of one sector. returns the shot index (counted from first_shot) and
+    # the matched pair of every pair found, as expected by correction_masks.
+    # takes the lattice size instead of a Lattice so that it can be sent to a process pool cheaply
+    ToricLattice = Lattice(rows, cols)
+    shots = []
+    pairs = []
+    for shot in range(len(syndromes)):
+        shot_pairs = matching_pairs(ToricLattice, np.flatnonzero(syndromes[shot]).tolist(), shape)
+        shots.extend([first_shot + shot] * len(shot_pairs))
+        pairs.extend(shot_pairs)
+    return shots, pairs
+
+
+def correction_masks(ToricLattice, shots, pairs, shape, num_shots):
+    # turns matched pairs into corrections without touching a circuit: pair m belongs to shot shots[m], and each shot's
+    # correction is the XOR of the path masks of its pairs. returns a num_shots x num_of_qubits 0/1 array
+    table = correction_path_table(ToricLattice.rows, ToricLattice.cols, shape)
+    corrections = np.zeros((num_shots, table.shape[2]), dtype=np.uint8)
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    np.bitwise_xor.at(corrections, np.asarray(shots, dtype=np.intp), table[pairs[:,0], pairs[:,1]])
+    return np.unpackbits(corrections, axis=1, count=ToricLattice.num_of_qubits)
+
+
+def matching_decoder(ToricLattice, star_syndromes, plaquette_syndromes, executor=None, chunks=1):
+    # decodes a batch of syndromes (num_shots x rows*cols arrays, one row per shot).
+    # returns the phase flip (Z) corrections from the star syndromes and the bit flip (X) corrections from the
+    # plaquette syndromes, as num_shots x num_of_qubits masks.
+    #
+    # if an executor (concurrent.futures thread or process pool) is given, the star and plaquette sectors are matched
+    # concurrently on it, each split into chunks batches of shots. matching is pure python, so a
+    # ProcessPoolExecutor is needed to use several cores; use functools.partial to pass a long-lived pool as decoder
+    corrections = []
+    for shape, syndromes in [('star', star_syndromes), ('plaquette', plaquette_syndromes)]:
+        bounds = np.linspace(0, len(syndromes), chunks + 1).astype(int)
+        tasks = [(ToricLattice.rows, ToricLattice.cols, syndromes[start:stop], shape, start) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if executor is None:
+            corrections.append([sector_matching_pairs(*task) for task in tasks])
+        else:
+            corrections.append([executor.submit(sector_matching_pairs, *task) for task in tasks])
+
+    for sector, (shape, syndromes) in enumerate([('star', star_syndromes), ('plaquette', plaquette_syndromes)]):
+        results = [result if executor is None else result.result() for result in corrections[sector]]
+        shots = [shot for result in results for shot in result[0]]
+        pairs = [pair for result in results for pair in result[1]]
+        corrections[sector] = correction_masks(ToricLattice, shots, pairs, shape, len(syndromes))
+    return corrections[0], corrections[1]
+
+
 def KitaevToricModel( x_0, x_1, k0, k1 , p_error, error=True):
 
  #### initialize torus data ###
@@ -224,4 +348,156 @@ def KitaevToricModel( x_0, x_1, k0, k1 , p_error, error=True):
             
             
             
-    return LatticeCircuit
\ No newline at end of file
+    return LatticeCircuit
+
+
+def KitaevToricOutcome( x_0, x_1, k0, k1 , p_error, error=True, prepare='circuit', errors=None):
+    # same experiment as KitaevToricModel, but the corrections are never applied to the circuit.
+    # the star syndromes, plaquette syndromes and the logical Z readouts are all measured in a single simulator run,
+    # both sectors are decoded into flat correction masks, and the decoded logical state is the measured
+    # logical parity XOR the parity of the bit flip correction on the logical Z supports
+    # (phase flip corrections commute with the Z readout). returns the decoded (x_0, x_1)
+    #
+    # prepare='circuit' prepares |x_0 x_1>_L with PrepareGroundState and the logical X circuits,
+    # prepare='stabilizer' loads the cached GroundStateStabilizer into the simulator instead, so that no
+    # state preparation gates are simulated
+    #
+    # errors, a list of (qubit, 'X' / 'Z' / 'Y') as returned by sample_sparse_pauli_errors, applies exactly these
+    # errors instead of sampling them with ApplyPauliError
+
+    ToricLattice = Lattice(k0,k1)
+    num_of_checks = ToricLattice.rows * ToricLattice.cols
+    DataQubits= QuantumRegister(ToricLattice.num_of_qubits, name='data')
+    syndromes = AncillaRegister(num_of_checks)
+    ZReadAncillas = AncillaRegister(2)
+    meas = ClassicalRegister(2*num_of_checks + 2)
+    LatticeCircuit= QuantumCircuit(DataQubits, syndromes, ZReadAncillas, meas)
+
+    if prepare == 'circuit':
+        LatticeCircuit.compose(PrepareGroundState(ToricLattice),qubits = DataQubits ,inplace = True)
+        if x_0 == 1:
+            LatticeCircuit.compose( LogicalX0_circuit(ToricLattice),  qubits = DataQubits, inplace = True )
+        if x_1 == 1:
+            LatticeCircuit.compose( LogicalX1_circuit(ToricLattice),  qubits = DataQubits, inplace = True )
+    elif prepare == 'stabilizer':
+        LatticeCircuit.set_stabilizer(GroundStateStabilizer(k0, k1, x_0, x_1, num_ancillas=num_of_checks + 2))
+    else:
+        raise ValueError("prepare must be 'circuit' or 'stabilizer'")
+
+    if errors is not None:
+        for qubit, pauli in errors:
+            getattr(LatticeCircuit, pauli.lower())(DataQubits[qubit])
+    elif error == True:
+        ApplyPauliError(LatticeCircuit, DataQubits, p_error)
+
+    syndrome_measurement(ToricLattice, LatticeCircuit, 'star', meas[0:num_of_checks])
+    syndrome_measurement(ToricLattice, LatticeCircuit, 'plaquette', meas[num_of_checks:2*num_of_checks])
+
+    ##### logical Z-parity measurements, x_0 then x_1 ####
+    logical_z = ToricLattice.logical_z_supports()
+    for i in range(2):
+        LatticeCircuit.h(ZReadAncillas[i])
+        for idx in np.flatnonzero(logical_z[i]):
+            LatticeCircuit.cz(ZReadAncillas[i], DataQubits[int(idx)])
+        LatticeCircuit.h(ZReadAncillas[i])
+        LatticeCircuit.measure(ZReadAncillas[i], meas[2*num_of_checks + i])
+
+    job = AerSimulator().run(LatticeCircuit, shots=1, memory=True)
+    memory_result = np.array(list(job.result().get_memory(LatticeCircuit)[0][::-1]), dtype=np.uint8)
+
+    star_syndromes = memory_result[None, 0:num_of_checks]
+    plaquette_syndromes = memory_result[None, num_of_checks:2*num_of_checks]
+    z_corrections, x_corrections = matching_decoder(ToricLattice, star_syndromes, plaquette_syndromes)
+
+    outcome = memory_result[2*num_of_checks:] ^ ((x_corrections[0] @ logical_z.T) % 2)
+    return int(outcome[0]), int(outcome[1])
+
+
+def logical_failure_rates(k0, k1, p_error, num_shots, decoder=matching_decoder, seed=None):
+    # estimates the logical failure rates for all four logical inputs |x_0 x_1>_L from a single batch of sampled errors.
+    #
+    # Under Pauli noise the decoded logical state is |x_0 x_1> up to the logical operators contained in
+    # (errors + corrections), and which logical operators these are does not depend on the input: the Z readout of
+    # KitaevToricModel returns x_i flipped by the parity of the residual bit flips on logical_z_supports()[i], and the
+    # logical phase of x_i is flipped by the parity of the residual phase flips on logical_x_supports()[i].
+    # So one batch of errors and decodings gives the failure rates for every input, without re-preparing the state.
+    #
+    # returns a dictionary with
+    #   'logical_x':  bit flip (logical X) failure rate of [x_0, x_1]
+    #   'logical_z':  phase flip (logical Z) failure rate of [x_0, x_1]
+    #   'any':        rate of shots with any logical error
+    #   'readout':    {(x_0, x_1): failure rate of the final Z readout}, as reported by execute_model(..., success=False)
+    #   'readout_failures':  {(x_0, x_1): number of shots on which the final Z readout failed}
+    ToricLattice = Lattice(k0,k1)
+
+    x_errors, z_errors = sample_pauli_errors(ToricLattice.num_of_qubits, p_error, num_shots, np.random.default_rng(seed))
+    star_syndromes = (z_errors @ ToricLattice.star_check_matrix().T) % 2
+    plaquette_syndromes = (x_errors @ ToricLattice.plaquette_check_matrix().T) % 2
+    z_corrections, x_corrections = decoder(ToricLattice, star_syndromes, plaquette_syndromes)
+
+    logical_x_failures = ((x_errors ^ x_corrections) @ ToricLattice.logical_z_supports().T) % 2
+    logical_z_failures = ((z_errors ^ z_corrections) @ ToricLattice.logical_x_supports().T) % 2
+
+    readout_failures = {}
+    for x_0, x_1 in itertools.product([0,1], repeat=2):
+        outcome = np.array([x_0, x_1]) ^ logical_x_failures
+        readout_failures[(x_0, x_1)] = int(np.count_nonzero((outcome != [x_0, x_1]).any(axis=1)))
+
+    return {
+        'logical_x': logical_x_failures.mean(axis=0),
+        'logical_z': logical_z_failures.mean(axis=0),
+        'any': float(np.mean(logical_x_failures.any(axis=1) | logical_z_failures.any(axis=1))),
+        'readout': {inputs: failures / num_shots for inputs, failures in readout_failures.items()},
+        'readout_failures': readout_failures,
+    }
+
+
+
+@functools.lru_cache(maxsize=None)
+def single_error_corrections(rows, cols):
+    # the corrections matching_decoder returns for a single error, per qubit: row q of the first table is the bit flip
+    # correction for a bit flip on qubit q, row q of the second the phase flip correction for a phase flip on qubit q
+    ToricLattice = Lattice(rows, cols)
+    single_errors = np.eye(ToricLattice.num_of_qubits, dtype=np.uint8)
+    z_corrections, x_corrections = matching_decoder(ToricLattice, (single_errors @ ToricLattice.star_check_matrix().T) % 2,
+                                                    (single_errors @ ToricLattice.plaquette_check_matrix().T) % 2)
+    return x_corrections, z_corrections
+
+
+def execute_model_sparse(x_0, x_1, k0, k1, p_error, num_shots, success=True, prepare='circuit', seed=None):
+    # success (or, with success=False, failure) rate of the final Z readout of |x_0 x_1>_L, as execute_model in the
+    # notebook, with a fast path for trivial shots:
+    #   - shots without errors succeed, nothing is simulated or decoded
+    #   - shots with a single error use the precomputed single_error_corrections; the readout fails if the residual
+    #     bit flips (error XOR correction) have odd parity on a logical Z support
+    #   - all other shots are run through KitaevToricOutcome with their sampled errors
+    # returns the rate (nan for num_shots = 0) and a Counter of how many shots took each path ('no_error', 'single_error', 'simulated')
+    if num_shots == 0:
+        return np.nan, collections.Counter()
+    ToricLattice = Lattice(k0,k1)
+    single_bit_flip_corrections, _ = single_error_corrections(k0, k1)
+    logical_z = ToricLattice.logical_z_supports()
+    path_counter = collections.Counter()
+
+    success_rate = 0
+    for errors in sample_sparse_pauli_errors(ToricLattice.num_of_qubits, p_error, num_shots, np.random.default_rng(seed)):
+        if len(errors) == 0:
+            path_counter['no_error'] += 1
+            success_rate += 1
+        elif len(errors) == 1:
+            path_counter['single_error'] += 1
+            qubit, pauli = errors[0]
+            if pauli == 'Z':
+                success_rate += 1
+            else:
+                residual = single_bit_flip_corrections[qubit].copy()
+                residual[qubit] ^= 1
+                success_rate += not ((residual @ logical_z.T) % 2).any()
+        else:
+            path_counter['simulated'] += 1
+            success_rate += KitaevToricOutcome(x_0, x_1, k0, k1, p_error, prepare=prepare, errors=errors) == (x_0, x_1)
+
+    if success == True:
+        return success_rate/num_shots, path_counter
+    if success == False:
+        return 1 - (success_rate/num_shots), path_counter
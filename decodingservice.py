@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import collections
+import struct
+import time
+import numpy as np
+from latticecode import *
+from KitaevToricCode import sample_pauli_errors, matching_decoder
+
+
+# Local decoding service for syndrome streams.
+#
+# Clients connect over a Unix socket or localhost TCP and send binary frames. Every frame consists of a header
+#
+#    request id (uint32, big endian) | payload length in bytes (uint32, big endian)
+#
+# followed by the payload. A request payload is np.packbits of the k^2 star syndromes followed by the k^2 plaquette
+# syndromes (stars_lin / plaquettes_lin order). The response carries the same request id and np.packbits of the
+# 2k^2 phase flip (Z) corrections followed by the 2k^2 bit flip (X) corrections, as flat masks over the data qubits.
+#
+# Requests arriving concurrently (from one or many connections) are coalesced into micro-batches: a batch is decoded
+# as soon as it holds max_batch_size requests, or max_delay seconds after its first request arrived.
+#
+# A response with an empty payload is an error: either the request payload did not have the expected
+# ceil(2k^2 / 8) bytes (the server then closes the connection, since it can not trust the stream any more),
+# or decoding the batch holding the request failed.
+
+HEADER = struct.Struct('!II')
+
+
+def encode_syndrome_frame(request_id, star_syndromes, plaquette_syndromes):
+    payload = np.packbits(np.concatenate([star_syndromes, plaquette_syndromes]).astype(np.uint8)).tobytes()
+    return HEADER.pack(request_id, len(payload)) + payload
+
+
+def decode_correction_payload(payload, num_of_qubits):
+    if len(payload) == 0:
+        raise RuntimeError('the decoding service returned an error response')
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=2*num_of_qubits)
+    return bits[:num_of_qubits], bits[num_of_qubits:]
+
+
+async def read_frame(reader):
+    request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return request_id, await reader.readexactly(length)
+
+
+class DecodingServer:
+    # wraps matching_decoder for a k x k toric lattice behind an asyncio server with micro-batching
+
+    def __init__(self, k, max_batch_size=64, max_delay=0.002, decoder=matching_decoder):
+        self.ToricLattice = Lattice(k,k)
+        self.num_of_checks = k*k
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.decoder = decoder
+
+        self.payload_size = (2*self.num_of_checks + 7) // 8
+        self.queue = None
+        self.connections = {}
+        self.latencies = collections.deque(maxlen=100000)
+        self.num_decoded = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.started = None
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        # listens on the Unix socket at path if given, otherwise on host:port
+        self.queue = asyncio.Queue()
+        self.started = time.perf_counter()
+        self.batcher = asyncio.create_task(self.batch_loop())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host=host, port=port)
+        return self.server
+
+    async def stop(self):
+        # stops accepting connections, stops the batcher, and closes the connections that are still open
+        self.server.close()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        for writer in list(self.connections.values()):
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def write_response(self, writer, request_id, payload=b''):
+        # an empty payload signals an error for request_id
+        if not writer.is_closing():
+            writer.write(HEADER.pack(request_id, len(payload)) + payload)
+
+    async def handle_client(self, reader, writer):
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if length != self.payload_size:
+                    # the payload can not be a syndrome frame of this lattice; answer with an error and hang up
+                    self.num_errors += 1
+                    self.write_response(writer, request_id)
+                    await writer.drain()
+                    break
+                payload = await reader.readexactly(length)
+                syndromes = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=2*self.num_of_checks)
+                await self.queue.put((time.perf_counter(), request_id, syndromes, writer))
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionResetError, BrokenPipeError):
+                pass
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][0] + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                syndromes = np.stack([request[2] for request in batch])
+                z_corrections, x_corrections = await loop.run_in_executor(
+                    None, self.decoder, self.ToricLattice, syndromes[:, :self.num_of_checks], syndromes[:, self.num_of_checks:])
+                payloads = [np.packbits(np.concatenate([z_correction, x_correction])).tobytes()
+                            for z_correction, x_correction in zip(z_corrections, x_corrections)]
+                if len(payloads) != len(batch):
+                    raise ValueError(f'decoder returned {len(payloads)} corrections for {len(batch)} requests')
+            except Exception as exc:
+                # answer every request of the batch with an error, and keep serving
+                print(f'decoding a batch of {len(batch)} requests failed: {exc!r}')
+                payloads = [b''] * len(batch)
+                self.num_errors += len(batch)
+
+            now = time.perf_counter()
+            for (received, request_id, _, writer), payload in zip(batch, payloads):
+                self.write_response(writer, request_id, payload)
+                self.latencies.append(now - received)
+            self.num_decoded += len(batch)
+            self.num_batches += 1
+
+    def stats(self):
+        # server side latency (from receiving a frame to writing its response) and throughput
+        return latency_stats(self.latencies, self.num_decoded, time.perf_counter() - self.started,
+                             num_batches=self.num_batches, num_errors=self.num_errors)
+
+
+def latency_stats(latencies, num_requests, elapsed, **extra):
+    latencies = np.asarray(latencies)
+    stats = {
+        'requests': num_requests,
+        'p50_latency': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+        'p99_latency': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+        'throughput': num_requests / elapsed if elapsed > 0 else float('nan'),
+    }
+    stats.update(extra)
+    return stats
+
+
+async def load_generator(k, p_error, num_requests, concurrency=8, host='127.0.0.1', port=8765, path=None, seed=None):
+    # benchmarking client: opens concurrency connections, each sending syndromes of randomly sampled Pauli errors
+    # one request at a time, and returns the client side p50/p99 latency and throughput
+    ToricLattice = Lattice(k,k)
+    star_H = ToricLattice.star_check_matrix()
+    plaquette_H = ToricLattice.plaquette_check_matrix()
+    x_errors, z_errors = sample_pauli_errors(ToricLattice.num_of_qubits, p_error, num_requests, np.random.default_rng(seed))
+    star_syndromes = (z_errors @ star_H.T) % 2
+    plaquette_syndromes = (x_errors @ plaquette_H.T) % 2
+
+    latencies = []
+
+    async def worker(request_ids):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        for request_id in request_ids:
+            sent = time.perf_counter()
+            writer.write(encode_syndrome_frame(request_id, star_syndromes[request_id], plaquette_syndromes[request_id]))
+            await writer.drain()
+            response_id, payload = await read_frame(reader)
+            decode_correction_payload(payload, ToricLattice.num_of_qubits)
+            latencies.append(time.perf_counter() - sent)
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(range(i, num_requests, concurrency)) for i in range(concurrency)])
+    return latency_stats(latencies, num_requests, time.perf_counter() - start, concurrency=concurrency)
+
+
+async def serve_and_benchmark(k, p_error, num_requests, concurrency, max_batch_size, max_delay, path=None, port=8765):
+    server = DecodingServer(k, max_batch_size=max_batch_size, max_delay=max_delay)
+    await server.start(port=port, path=path)
+    client_stats = await load_generator(k, p_error, num_requests, concurrency, port=port, path=path)
+    server_stats = server.stats()
+    await server.stop()
+    return client_stats, server_stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Toric code decoding service')
+    parser.add_argument('mode', choices=['serve', 'bench'])
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='Unix socket path (instead of localhost TCP)')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-delay', type=float, default=0.002, help='batching deadline in seconds')
+    parser.add_argument('-p', '--p-error', type=float, default=0.05)
+    parser.add_argument('-n', '--num-requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        async def serve():
+            server = DecodingServer(args.k, max_batch_size=args.max_batch_size, max_delay=args.max_delay)
+            await server.start(port=args.port, path=args.unix)
+            try:
+                while True:
+                    await asyncio.sleep(10)
+                    print(server.stats())
+            finally:
+                await server.stop()
+        asyncio.run(serve())
+    else:
+        client_stats, server_stats = asyncio.run(serve_and_benchmark(
+            args.k, args.p_error, args.num_requests, args.concurrency, args.max_batch_size, args.max_delay, path=args.unix, port=args.port))
+        print('client:', client_stats)
+        print('server:', server_stats)
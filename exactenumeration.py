@@ -0,0 +1,128 @@
+import functools
+import numpy as np
+from numpy.polynomial import Polynomial
+from latticecode import *
+from KitaevToricCode import matching_decoder
+
+
+# Exact logical failure rates for small lattices by exhaustive enumeration.
+#
+# Under the Pauli channel of ApplyPauliError every data qubit independently carries a bit flip (X or Y) with
+# probability 2p/3, and a phase flip (Z or Y) with probability 2p/3. The bit flips are detected by the plaquettes
+# and decide the Z readout of the logical qubits, the phase flips are detected by the stars and decide their phase.
+# So within a sector, the logical failure rate is
+#
+#    sum_w A_w q^w (1 - q)^(n - w),     q = 2p/3,  n = 2 rows cols,
+#
+# where A_w is the number of error patterns of weight w that the matching decoder fails on. A_w is found by
+# enumerating all 2^n patterns of the sector (2^18 for 3x3, 2^32 for 4x4) in vectorized chunks. Error patterns are
+# handled as integers whose bit q is qubit q; syndromes, logical parities and weights are looked up one byte at a time.
+# Every syndrome is decoded only once, see decoded_logical_parities.
+
+
+def byte_lookup_tables(columns, num_of_qubits):
+    # columns[q] is the integer code (syndrome bits, logical bits, ...) contributed by an error on qubit q.
+    # returns a ceil(num_of_qubits / 8) x 256 table, entry [b, v] is the XOR of the codes of the qubits set in byte b = v
+    values = np.arange(256, dtype=np.uint64)
+    tables = np.zeros(((num_of_qubits + 7) // 8, 256), dtype=np.uint64)
+    for q in range(num_of_qubits):
+        tables[q // 8] ^= ((values >> np.uint64(q % 8)) & np.uint64(1)) * np.uint64(columns[q])
+    return tables
+
+
+def integer_codes(matrix):
+    # packs the columns of a binary matrix into integers, bit j of the code of column q is matrix[j, q]
+    return (matrix.astype(np.uint64) << np.arange(matrix.shape[0], dtype=np.uint64)[:, None]).sum(axis=0)
+
+
+def sector_matrices(ToricLattice, shape):
+    # check matrix and logical supports of a sector: 'plaquette' for bit flips, 'star' for phase flips
+    if shape == 'plaquette':
+        return ToricLattice.plaquette_check_matrix(), ToricLattice.logical_z_supports()
+    if shape == 'star':
+        return ToricLattice.star_check_matrix(), ToricLattice.logical_x_supports()
+    raise ValueError("shape must be 'star' or 'plaquette'")
+
+
+@functools.lru_cache(maxsize=None)
+def decoded_logical_parities(rows, cols, shape, batch_size=4096):
+    # decodes every syndrome of the sector once with matching_decoder and returns an array indexed by the integer
+    # syndrome, holding the parity of the correction on the two logical supports (bit i for logical qubit i).
+    # syndromes of odd weight can not occur and are left at 0
+    ToricLattice = Lattice(rows, cols)
+    H, logical = sector_matrices(ToricLattice, shape)
+    num_of_checks = H.shape[0]
+
+    syndromes = np.arange(2**num_of_checks, dtype=np.uint64)
+    bits = ((syndromes[:, None] >> np.arange(num_of_checks, dtype=np.uint64)) & np.uint64(1)).astype(np.uint8)
+    valid = np.flatnonzero(bits.sum(axis=1) % 2 == 0)
+
+    parities = np.zeros(2**num_of_checks, dtype=np.uint8)
+    empty = np.zeros((batch_size, num_of_checks), dtype=np.uint8)
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        if shape == 'star':
+            corrections, _ = matching_decoder(ToricLattice, bits[batch], empty[:len(batch)])
+        if shape == 'plaquette':
+            _, corrections = matching_decoder(ToricLattice, empty[:len(batch)], bits[batch])
+        parities[batch] = integer_codes(((corrections @ logical.T) % 2).T).astype(np.uint8)
+    return parities
+
+
+def pattern_codes(patterns, syndrome_tables, logical_tables, popcount):
+    # syndromes, logical parities and weights of an array of integer error patterns
+    syndromes = np.zeros(len(patterns), dtype=np.uint64)
+    parities = np.zeros(len(patterns), dtype=np.uint64)
+    weights = np.zeros(len(patterns), dtype=np.uint64)
+    for b in range(len(syndrome_tables)):
+        byte = (patterns >> np.uint64(8*b)) & np.uint64(255)
+        syndromes ^= syndrome_tables[b][byte]
+        parities ^= logical_tables[b][byte]
+        weights += popcount[byte]
+    return syndromes, parities, weights
+
+
+def enumerate_logical_failures(k0, k1, shape='plaquette', chunk_size=2**22):
+    # enumerates all bit flip (shape='plaquette') or phase flip (shape='star') patterns of a k0 x k1 lattice and
+    # returns the number of patterns of each weight on which decoding fails, as arrays of length 2 k0 k1 + 1:
+    #   'x_0', 'x_1':  failures of logical qubit x_0 / x_1
+    #   'any':         failures of either logical qubit (for shape='plaquette': failures of the final Z readout)
+    #
+    # patterns are split into their low 16 bits and the remaining high bits; the codes of all low halves are computed
+    # once, and each chunk combines a range of high halves with all of them
+    ToricLattice = Lattice(k0,k1)
+    n = ToricLattice.num_of_qubits
+    H, logical = sector_matrices(ToricLattice, shape)
+
+    tables = (byte_lookup_tables(integer_codes(H), n), byte_lookup_tables(integer_codes(logical), n),
+              np.array([bin(v).count('1') for v in range(256)], dtype=np.uint64))
+    decoded = decoded_logical_parities(k0, k1, shape)
+
+    low_bits = min(n, 16)
+    low_syndromes, low_parities, low_weights = pattern_codes(np.arange(2**low_bits, dtype=np.uint64), *tables)
+    highs_per_chunk = max(1, chunk_size // 2**low_bits)
+
+    failure_counts = np.zeros(4*(n + 1), dtype=np.int64)
+    for start in range(0, 2**(n - low_bits), highs_per_chunk):
+        highs = np.arange(start, min(start + highs_per_chunk, 2**(n - low_bits)), dtype=np.uint64) << np.uint64(low_bits)
+        high_syndromes, high_parities, high_weights = pattern_codes(highs, *tables)
+
+        syndromes = high_syndromes[:, None] ^ low_syndromes[None, :]
+        failures = high_parities[:, None] ^ low_parities[None, :] ^ decoded[syndromes]
+        weights = high_weights[:, None] + low_weights[None, :]
+        failure_counts += np.bincount((4*weights + failures).ravel().astype(np.intp), minlength=4*(n + 1))
+
+    # failure_counts[4w + f] counts the patterns of weight w whose logical failure bits are f
+    failure_counts = failure_counts.reshape(n + 1, 4)
+    return {
+        'x_0': failure_counts[:, 1] + failure_counts[:, 3],
+        'x_1': failure_counts[:, 2] + failure_counts[:, 3],
+        'any': failure_counts[:, 1:].sum(axis=1),
+    }
+
+
+def failure_polynomial(counts):
+    # the exact logical failure rate sum_w A_w q^w (1 - q)^(n - w), q = 2p/3, as a polynomial in the physical error rate p
+    n = len(counts) - 1
+    q = Polynomial([0, 2/3])
+    return sum((int(A_w) * q**w * (1 - q)**(n - w) for w, A_w in enumerate(counts) if A_w), Polynomial([0]))
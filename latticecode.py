@@ -2,6 +2,11 @@ import qiskit
 import numpy as np
 import networkx as nx
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 class Lattice:
     # Initializes a lattice configuration suitable for Kitaev's toric code. 
@@ -152,31 +157,75 @@ class Lattice:
         for i in range(self.rows):
             for j in range(self.cols):
                 self.stars[i][j].qubits = [ LatticeCircuit.qubits[idx] for idx in self.get_star_indices(i,j)]
-                
+
+    def populate_flat_indices(self):
+        # same as populate_plaquettes / populate_stars, but stores flat indices instead of circuit qubits,
+        # so that plaquette_path and star_path return flat indices which can be used to index numpy arrays
+        for i in range(self.rows):
+            for j in range(self.cols):
+                self.plaquettes[i][j].qubits = self.get_plaquette_indices(i,j)
+                self.stars[i][j].qubits = self.get_star_indices(i,j)
+
+    def plaquette_check_matrix(self):
+        # returns a (rows*cols) x num_of_qubits binary matrix, row m marks the qubits of plaquettes_lin[m].
+        # multiplying (mod 2) with a vector of bit flips gives the plaquette syndromes
+        H = np.zeros((self.rows*self.cols, self.num_of_qubits), dtype=np.uint8)
+        for m, P in enumerate(self.plaquettes_lin):
+            for idx in self.get_plaquette_indices(P.row_idx, P.col_idx):
+                H[m, idx] ^= 1
+        return H
+
+    def star_check_matrix(self):
+        # returns a (rows*cols) x num_of_qubits binary matrix, row m marks the qubits of stars_lin[m].
+        # multiplying (mod 2) with a vector of phase flips gives the star syndromes
+        H = np.zeros((self.rows*self.cols, self.num_of_qubits), dtype=np.uint8)
+        for m, S in enumerate(self.stars_lin):
+            for idx in self.get_star_indices(S.row_idx, S.col_idx):
+                H[m, idx] ^= 1
+        return H
+
+    def logical_z_supports(self):
+        # returns a 2 x num_of_qubits binary matrix marking the supports of the logical Z operators read out at the
+        # end of KitaevToricModel. row 0: horizontal edges of the top row (reads x_0),
+        # row 1: vertical edges of the left column (reads x_1)
+        L = np.zeros((2, self.num_of_qubits), dtype=np.uint8)
+        for j in range(self.cols):
+            L[0, self.get_flat_index_horizontal(0, j)] = 1
+        for i in range(self.rows):
+            L[1, self.get_flat_index_vertical(i, 0)] = 1
+        return L
+
+    def logical_x_supports(self):
+        # returns a 2 x num_of_qubits binary matrix marking the supports of the logical X operators
+        # (cf. LogicalX0_circuit and LogicalX1_circuit). row 0: horizontal edges of the left column (flips x_0),
+        # row 1: vertical edges of the top row (flips x_1)
+        L = np.zeros((2, self.num_of_qubits), dtype=np.uint8)
+        for i in range(self.rows):
+            L[0, self.get_flat_index_horizontal(i, 0)] = 1
+        for j in range(self.cols):
+            L[1, self.get_flat_index_vertical(0, j)] = 1
+        return L
+
             
     def marked_plaquettes_graph(self, marked_plaquettes):
         # returns a weighted graph of marked plaquettes, edges are weighted by the distance between marked plaquettes
-        plaquette_graph = nx.complete_graph(len(marked_plaquettes))
-        
-        labels_dict = dict(enumerate(marked_plaquettes) )
-        plaquette_graph = nx.relabel_nodes(plaquette_graph, labels_dict)
-        
-        for edge in plaquette_graph.edges:
-            
-            plaquette_graph.edges[ edge[0], edge[1] ]['weight'] = self.plaquettes_lin[edge[0]].dist(self.plaquettes_lin[edge[1]], self.rows, self.cols)
-        return plaquette_graph     
+        return self.marked_graph(marked_plaquettes)
 
     def marked_stars_graph(self, marked_stars):
         # returns a weighted graph of marked stars, edges are weighted by the distance between marked stars
-        star_graph = nx.complete_graph(len(marked_stars))
-        
-        labels_dict = dict(enumerate(marked_stars) )
-        star_graph = nx.relabel_nodes(star_graph, labels_dict)
-        
-        for edge in star_graph.edges:
-            
-            star_graph.edges[ edge[0], edge[1] ]['weight'] = self.stars_lin[edge[0]].dist(self.stars_lin[edge[1]], self.rows, self.cols)
-        return star_graph     
+        return self.marked_graph(marked_stars)
+
+    def marked_graph(self, marked):
+        # complete graph on the marked (linear) indices, weighted by their distance on the torus.
+        # stars and plaquettes share the same (row, col) grid and distance, see Star.dist and Plaquette.dist.
+        # nodes and edges are added in the same order as nx.complete_graph, so that matchings are unchanged
+        marked = np.asarray(marked, dtype=np.int64)
+        weights = torus_distance_matrix(marked // self.cols, marked % self.cols, self.rows, self.cols)
+        graph = nx.Graph()
+        graph.add_nodes_from(marked.tolist())
+        i, j = np.triu_indices(len(marked), k=1)
+        graph.add_weighted_edges_from(zip(marked[i].tolist(), marked[j].tolist(), weights[i, j].tolist()))
+        return graph
                 
     
     def plaquette_path(self, LatticeCircuit, P1,P2):
@@ -297,4 +346,115 @@ class Star:
             hor = hor + width              
         
         return abs(hor) + abs(vert)             
-        
\ No newline at end of file
+        
+
+
+# Kernels for decoding.
+#
+# torus_distance_matrix and path_table compute the same distances and paths as Star.dist / Plaquette.dist and
+# star_path / plaquette_path, for many stars or plaquettes at once. When numba is installed the compiled loop versions
+# are used, otherwise the vectorized numpy versions.
+
+
+def torus_distance_matrix_numpy(row_idx, col_idx, height, width):
+    vert = np.abs(row_idx[:, None] - row_idx[None, :])
+    hor = np.abs(col_idx[:, None] - col_idx[None, :])
+    return np.minimum(vert, height - vert) + np.minimum(hor, width - hor)
+
+
+def path_table_numpy(rows, cols, shape):
+    # returns a (rows*cols)^2 x 2*rows*cols table, row a*rows*cols + b is the flat mask of star_path
+    # (or plaquette_path) from stars_lin[a] to stars_lin[b]. all paths are walked at once, one step at a time
+    num_of_nodes = rows*cols
+    source, target = np.divmod(np.arange(num_of_nodes**2), num_of_nodes)
+    r, c = np.divmod(source, cols)
+    r2, c2 = np.divmod(target, cols)
+    table = np.zeros((num_of_nodes**2, 2*rows*cols), dtype=np.uint8)
+
+    def h(x, y):
+        return 2*(x % rows)*cols + y % cols
+
+    def v(x, y):
+        return 2*(x % rows)*cols + y % cols + cols
+
+    def walk(pos, goal, size, fwd_qubit, back_qubit):
+        for _ in range(size):
+            active = np.flatnonzero(pos != goal)
+            if len(active) == 0:
+                break
+            fwd = np.abs((pos + 1) % size - goal)
+            back = np.abs((pos - 1) % size - goal)
+            go_fwd = np.minimum(fwd, size - fwd) < np.minimum(back, size - back)
+            qubit = np.where(go_fwd, fwd_qubit(), back_qubit())
+            table[active, qubit[active]] ^= 1
+            pos[active] = np.where(go_fwd, pos + 1, pos - 1)[active] % size
+
+    if shape == 'star':
+        walk(c, c2, cols, lambda: h(r + 1, c), lambda: h(r + 1, c - 1))
+        walk(r, r2, rows, lambda: v(r + 1, c), lambda: v(r, c))
+    if shape == 'plaquette':
+        walk(r, r2, rows, lambda: h(r + 1, c), lambda: h(r, c))
+        walk(c, c2, cols, lambda: v(r, c + 1), lambda: v(r, c))
+    return table
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def torus_distance_matrix_numba(row_idx, col_idx, height, width):
+        n = len(row_idx)
+        D = np.zeros((n, n), dtype=np.int64)
+        for i in range(n):
+            for j in range(n):
+                vert = abs(row_idx[i] - row_idx[j])
+                hor = abs(col_idx[i] - col_idx[j])
+                D[i, j] = min(vert, height - vert) + min(hor, width - hor)
+        return D
+
+    @numba.njit(cache=True)
+    def path_table_numba(rows, cols, is_star):
+        num_of_nodes = rows*cols
+        table = np.zeros((num_of_nodes**2, 2*rows*cols), dtype=np.uint8)
+        for a in range(num_of_nodes):
+            for b in range(num_of_nodes):
+                row = a*num_of_nodes + b
+                r, c = a // cols, a % cols
+                r2, c2 = b // cols, b % cols
+                for phase in range(2):
+                    # stars walk the columns first, plaquettes the rows first
+                    along_cols = (phase == 0) == is_star
+                    while (c != c2) if along_cols else (r != r2):
+                        size = cols if along_cols else rows
+                        pos = c if along_cols else r
+                        goal = c2 if along_cols else r2
+                        fwd = abs((pos + 1) % size - goal)
+                        back = abs((pos - 1) % size - goal)
+                        go_fwd = min(fwd, size - fwd) < min(back, size - back)
+                        if is_star and along_cols:
+                            qubit = 2*((r + 1) % rows)*cols + (c if go_fwd else (c - 1) % cols)
+                        elif is_star:
+                            qubit = 2*(((r + 1) % rows) if go_fwd else r)*cols + c + cols
+                        elif along_cols:
+                            qubit = 2*r*cols + (((c + 1) % cols) if go_fwd else c) + cols
+                        else:
+                            qubit = 2*(((r + 1) % rows) if go_fwd else r)*cols + c
+                        table[row, qubit] ^= 1
+                        step = 1 if go_fwd else -1
+                        if along_cols:
+                            c = (c + step) % cols
+                        else:
+                            r = (r + step) % rows
+        return table
+
+
+def torus_distance_matrix(row_idx, col_idx, height, width):
+    # pairwise distances on a height x width torus between the grid points (row_idx[i], col_idx[i])
+    if numba is not None:
+        return torus_distance_matrix_numba(row_idx, col_idx, height, width)
+    return torus_distance_matrix_numpy(row_idx, col_idx, height, width)
+
+
+def path_table(rows, cols, shape):
+    if numba is not None:
+        return path_table_numba(rows, cols, shape == 'star')
+    return path_table_numpy(rows, cols, shape)
@@ -0,0 +1,116 @@
+import json
+import os
+import numpy as np
+from latticecode import *
+from KitaevToricCode import sample_pauli_errors, matching_decoder
+
+
+# Generation and replay of syndrome datasets.
+#
+# A dataset is a directory holding one memory-mapped .npy file per field, plus a small metadata.json:
+#
+#    x_errors.npy              bit flips sampled on the data qubits            (num_shots x 2k^2)
+#    z_errors.npy              phase flips sampled on the data qubits          (num_shots x 2k^2)
+#    star_syndromes.npy        star syndromes (detect the phase flips)         (num_shots x k^2)
+#    plaquette_syndromes.npy   plaquette syndromes (detect the bit flips)      (num_shots x k^2)
+#    logical.npy               reference logical outcome of the raw errors     (num_shots x 4)
+#
+# The columns of logical.npy are: bit flip of x_0, bit flip of x_1, phase flip of x_0, phase flip of x_1,
+# i.e. the parity of the errors on the supports of Lattice.logical_z_supports() and Lattice.logical_x_supports().
+# A decoder fails on a shot exactly when the parity of its correction on these supports differs from the reference.
+#
+# With packed=True every field is stored with np.packbits along the qubit/syndrome axis (8 bits per byte).
+#
+# The syndromes are computed from the stabilizer supports of the Lattice, which is what the (noiseless) syndrome
+# measurements of KitaevToricModel return for the same Pauli errors, so that the noise only needs to be sampled once
+# for any number of decoders.
+
+FIELDS = ['x_errors', 'z_errors', 'star_syndromes', 'plaquette_syndromes', 'logical']
+
+
+def generate_syndrome_dataset(path, k, p_error, num_shots, seed=None, packed=True, chunk_size=10000):
+    # samples num_shots Pauli errors on a k x k toric lattice and writes errors, syndromes and reference logical
+    # outcomes to the directory path, chunk by chunk, without holding the whole dataset in memory
+    ToricLattice = Lattice(k,k)
+    star_H = ToricLattice.star_check_matrix()
+    plaquette_H = ToricLattice.plaquette_check_matrix()
+    logical_supports = np.concatenate([ToricLattice.logical_z_supports(), ToricLattice.logical_x_supports()])
+    rng = np.random.default_rng(seed)
+
+    widths = {
+        'x_errors': ToricLattice.num_of_qubits,
+        'z_errors': ToricLattice.num_of_qubits,
+        'star_syndromes': k*k,
+        'plaquette_syndromes': k*k,
+        'logical': 4,
+    }
+
+    os.makedirs(path, exist_ok=True)
+    files = {}
+    for field in FIELDS:
+        width = (widths[field] + 7) // 8 if packed else widths[field]
+        files[field] = np.lib.format.open_memmap(os.path.join(path, field + '.npy'), mode='w+', dtype=np.uint8, shape=(num_shots, width))
+
+    for start in range(0, num_shots, chunk_size):
+        stop = min(start + chunk_size, num_shots)
+        x_errors, z_errors = sample_pauli_errors(ToricLattice.num_of_qubits, p_error, stop - start, rng)
+        chunk = {
+            'x_errors': x_errors,
+            'z_errors': z_errors,
+            'star_syndromes': (z_errors @ star_H.T) % 2,
+            'plaquette_syndromes': (x_errors @ plaquette_H.T) % 2,
+            'logical': np.concatenate([x_errors @ logical_supports[0:2].T, z_errors @ logical_supports[2:4].T], axis=1) % 2,
+        }
+        for field in FIELDS:
+            data = chunk[field].astype(np.uint8)
+            files[field][start:stop] = np.packbits(data, axis=1) if packed else data
+
+    for field in FIELDS:
+        files[field].flush()
+    del files
+
+    metadata = {'k': k, 'p_error': p_error, 'seed': seed, 'num_shots': num_shots, 'packed': packed, 'widths': widths}
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def load_metadata(path):
+    with open(os.path.join(path, 'metadata.json')) as f:
+        return json.load(f)
+
+
+def replay_syndrome_dataset(path, chunk_size=10000, fields=FIELDS):
+    # yields the dataset at path as dictionaries {field: num_shots_in_chunk x width uint8 array}, chunk by chunk.
+    # files are opened memory-mapped, so only the current chunk is read from disk
+    metadata = load_metadata(path)
+    files = {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r') for field in fields}
+
+    for start in range(0, metadata['num_shots'], chunk_size):
+        stop = min(start + chunk_size, metadata['num_shots'])
+        chunk = {}
+        for field in fields:
+            if metadata['packed']:
+                chunk[field] = np.unpackbits(files[field][start:stop], axis=1, count=metadata['widths'][field])
+            else:
+                chunk[field] = np.array(files[field][start:stop])
+        yield chunk
+
+
+def evaluate_decoder(path, decoder=matching_decoder, chunk_size=10000):
+    # streams the syndromes of the dataset at path into decoder and returns the logical failure rates as an array
+    # [bit flip of x_0, bit flip of x_1, phase flip of x_0, phase flip of x_1].
+    # decoder is called as decoder(ToricLattice, star_syndromes, plaquette_syndromes) and must return
+    # (z_corrections, x_corrections) as num_shots x num_of_qubits masks, cf. matching_decoder
+    metadata = load_metadata(path)
+    ToricLattice = Lattice(metadata['k'], metadata['k'])
+    logical_z = ToricLattice.logical_z_supports()
+    logical_x = ToricLattice.logical_x_supports()
+
+    failures = np.zeros(4, dtype=np.int64)
+    for chunk in replay_syndrome_dataset(path, chunk_size, fields=['star_syndromes', 'plaquette_syndromes', 'logical']):
+        z_corrections, x_corrections = decoder(ToricLattice, chunk['star_syndromes'], chunk['plaquette_syndromes'])
+        correction_parity = np.concatenate([x_corrections @ logical_z.T, z_corrections @ logical_x.T], axis=1) % 2
+        failures += (correction_parity != chunk['logical']).sum(axis=0)
+
+    return failures / metadata['num_shots']
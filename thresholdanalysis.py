@@ -0,0 +1,197 @@
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import brentq, curve_fit
+from scipy.special import erfc
+
+
+# Threshold estimation from stored sweep counts.
+#
+# A sweep is stored as
+#
+#    error_rates   physical error rates p                                   (P,)
+#    distances     lattice sizes k                                          (K,)
+#    failures      number of shots with a logical failure at (k, p)         (K x P)
+#    shots         number of shots at (k, p)                                (K x P)
+#
+# Cells with shots == 0 (points missing from a sweep) are left out of every fit.
+#
+# The threshold p_th is estimated either from the crossings of the per-k fits of threshold_fit_function
+# (method='crossing'), or from a finite-size scaling collapse of all curves at once (method='collapse'), where
+#
+#    p_L = A + B x + C x^2,     x = (p - p_th) k^(1/nu).
+#
+# Confidence intervals come from a parametric bootstrap: every resample redraws all failure counts of all curves at
+# once from binomial distributions, and the resamples are fitted in parallel across processes. Resamples whose fit
+# fails are not simply dropped: if more than max_failed of them fail, the interval is reported as nan.
+
+
+def threshold_fit_function(p, A, p_th, sigma):
+    """
+    p: physical error rate (x-axis)
+    A: amplitude/scaling factor
+    p_th: threshold location
+    sigma: width/steepness of the transition
+    """
+    return A * 0.5 * erfc((p_th - p) / sigma)
+
+
+def collapse_fit_function(pk, p_th, nu, A, B, C):
+    """
+    pk: pair (p, k) of physical error rates and lattice sizes, flattened over all curves
+    p_th: threshold
+    nu: scaling exponent of the correlation length
+    A, B, C: coefficients of the quadratic scaling function
+    """
+    p, k = pk
+    x = (p - p_th) * k**(1/nu)
+    return A + B*x + C*x**2
+
+
+def run_sweep(distances, error_rates, num_shots, seed=None):
+    # runs logical_failure_rates for every (k, p) and returns the failure counts of the final Z readout
+    # (the quantity plotted in the notebook) together with the shot counts.
+    # KitaevToricCode is imported here, so that the fitting functions (and their worker processes) do not load qiskit
+    from KitaevToricCode import logical_failure_rates
+
+    rng = np.random.default_rng(seed)
+    failures = np.zeros((len(distances), len(error_rates)), dtype=np.int64)
+    for i, k in enumerate(distances):
+        for j, p in enumerate(error_rates):
+            rates = logical_failure_rates(k, k, p, num_shots, seed=rng.integers(2**32))
+            failures[i, j] = rates['readout_failures'][(0,0)]
+    return failures, np.full_like(failures, num_shots)
+
+
+def save_sweep(path, error_rates, distances, failures, shots):
+    np.savez(path, error_rates=error_rates, distances=distances, failures=failures, shots=shots)
+
+
+def load_sweep(path):
+    data = np.load(path)
+    return data['error_rates'], data['distances'], data['failures'], data['shots']
+
+
+def failure_rates(failures, shots):
+    # failures / shots, nan where no shots were taken
+    failures = np.asarray(failures, dtype=float)
+    shots = np.asarray(shots, dtype=float)
+    return np.divide(failures, shots, out=np.full(failures.shape, np.nan), where=shots > 0)
+
+
+def fit_crossing(error_rates, distances, rates, p0=(1.0, 0.1, 0.02)):
+    # fits threshold_fit_function to each curve and returns the mean of the crossing points of the fitted functions
+    # of consecutive lattice sizes. pairs whose fits do not cross within the range of error_rates are left out;
+    # nan if no pair crosses or a fit fails
+    fits = []
+    for curve in rates:
+        valid = np.isfinite(curve)
+        try:
+            params, _ = curve_fit(threshold_fit_function, error_rates[valid], curve[valid], p0=p0, maxfev=5000)
+        except (RuntimeError, TypeError):
+            # TypeError: fewer valid points than parameters
+            return np.nan
+        fits.append(params)
+
+    p_grid = np.linspace(np.min(error_rates), np.max(error_rates), 200)
+    crossings = []
+    for small, large in zip(fits[:-1], fits[1:]):
+        def difference(p):
+            return threshold_fit_function(p, *large) - threshold_fit_function(p, *small)
+        sign_change = np.flatnonzero(np.diff(np.sign(difference(p_grid))) != 0)
+        if len(sign_change):
+            i = sign_change[0]
+            crossings.append(brentq(difference, p_grid[i], p_grid[i + 1]))
+    return float(np.mean(crossings)) if crossings else np.nan
+
+
+def fit_collapse(error_rates, distances, rates, p0=None):
+    # fits collapse_fit_function to all curves at once and returns (p_th, nu, A, B, C), or nans if the fit fails
+    p = np.tile(error_rates, len(distances))
+    k = np.repeat(distances, len(error_rates)).astype(float)
+    rates = np.ravel(rates)
+    valid = np.isfinite(rates)
+    if p0 is None:
+        p0 = [np.mean(error_rates), 1.0, np.mean(rates[valid]), 1.0, 0.0]
+    try:
+        params, _ = curve_fit(collapse_fit_function, (p[valid], k[valid]), rates[valid], p0=p0, maxfev=5000)
+    except (RuntimeError, TypeError):
+        return np.full(5, np.nan)
+    return params
+
+
+def bootstrap_rates(failures, shots, num_bootstrap, rng=None):
+    # draws num_bootstrap resamples of all curves at once, returns a num_bootstrap x K x P array of failure rates
+    # (nan in the cells without shots)
+    if rng is None:
+        rng = np.random.default_rng()
+    shots = np.asarray(shots)
+    p = np.nan_to_num(failure_rates(failures, shots))
+    resampled = rng.binomial(shots, p, size=(num_bootstrap,) + shots.shape)
+    return failure_rates(resampled, np.broadcast_to(shots, resampled.shape))
+
+
+def fit_bootstrap_chunk(args):
+    # fits a chunk of bootstrap resamples, returns one threshold estimate (crossing) or parameter row (collapse) per resample
+    error_rates, distances, resamples, method, p0 = args
+    if method == 'crossing':
+        return np.array([fit_crossing(error_rates, distances, rates, p0) for rates in resamples])
+    if method == 'collapse':
+        return np.array([fit_collapse(error_rates, distances, rates, p0) for rates in resamples])
+    raise ValueError("method must be 'crossing' or 'collapse'")
+
+
+def bootstrap_threshold(error_rates, distances, failures, shots, num_bootstrap=1000, method='collapse',
+                        confidence=0.95, processes=None, seed=None, max_failed=0.05):
+    # estimates p_th from the sweep counts, with a bootstrap confidence interval computed on up to processes cores.
+    # returns a dictionary with the point estimate 'p_th', the confidence 'interval', the bootstrap 'samples'
+    # of p_th, the fraction of resamples whose fit 'failed', and for method='collapse' the fitted 'params'.
+    # if more than max_failed of the resamples fail, the interval would only describe the resamples that happened to
+    # fit, so it is reported as (nan, nan) with a warning
+    error_rates = np.asarray(error_rates, dtype=float)
+    distances = np.asarray(distances)
+    rates = failure_rates(failures, shots)
+
+    if method == 'crossing':
+        p0 = (1.0, 0.1, 0.02)
+        estimate = fit_crossing(error_rates, distances, rates, p0)
+    elif method == 'collapse':
+        p0 = fit_collapse(error_rates, distances, rates)
+        if np.isnan(p0).any():
+            raise RuntimeError('the finite-size scaling collapse fit of the sweep failed, no starting point for the bootstrap fits')
+        estimate = p0[0]
+    else:
+        raise ValueError("method must be 'crossing' or 'collapse'")
+
+    resamples = bootstrap_rates(failures, shots, num_bootstrap, np.random.default_rng(seed))
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, num_bootstrap))
+    chunks = [(error_rates, distances, chunk, method, p0) for chunk in np.array_split(resamples, processes) if len(chunk)]
+
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            fits = np.concatenate(list(executor.map(fit_bootstrap_chunk, chunks)))
+    else:
+        fits = np.concatenate([fit_bootstrap_chunk(chunk) for chunk in chunks])
+
+    samples = fits if method == 'crossing' else fits[:, 0]
+    failed = float(np.mean(np.isnan(samples)))
+    alpha = (1 - confidence) / 2
+    if failed > max_failed:
+        warnings.warn(f'{failed:.0%} of the bootstrap fits failed (more than max_failed = {max_failed:.0%}), '
+                      'the confidence interval is not reported')
+        interval = (np.nan, np.nan)
+    else:
+        interval = tuple(np.nanquantile(samples, [alpha, 1 - alpha]))
+
+    result = {
+        'p_th': float(estimate),
+        'interval': interval,
+        'samples': samples,
+        'failed': failed,
+    }
+    if method == 'collapse':
+        result['params'] = p0
+    return result